@@ -14,13 +14,29 @@
 ################################################################################
 
 import argparse
+import copy
+import hashlib
+import io
+import json
 import os
 import re
 import random
+import shutil
+import signal
 import math
 import string
+import subprocess
 import pickle
+import sys
+import tarfile
 import time
+import zipfile
+
+try:
+    import fcntl
+except ImportError:
+    # Registry locking is only available on POSIX systems
+    fcntl = None
 
 
 # File Property
@@ -116,12 +132,12 @@ class FileProperty:
         return filename + "." + file_extension
 
     def get_extension(self):
-        """Returns the extension of the file"""
+        """Returns the extension of the file, or None if it has none"""
         try:
             (_, file_extension) = self.__file_name_pattern.match(
                 self.__filepath).groups()
         except AttributeError:
-            print("No file extension")
+            return None
         return file_extension
 
     def get_ctime(self):
@@ -154,11 +170,16 @@ class Header:
     __username = ""
     __email = ""
     __file_data = None
+    __create_time = None
 
-    def __init__(self, username, email, filepath):
-        """Create a new header object"""
+    def __init__(self, username, email, filepath, create_time=None):
+        """
+        Create a new header object
+        The create time overrides the one of the file, for files not on disk.
+        """
         self.__username = username
         self.__email = email
+        self.__create_time = create_time
 
         self.__file_data = FileProperty(filepath)
 
@@ -188,6 +209,8 @@ class Header:
 
     def get_create_time(self):
         """Returns the last modified time"""
+        if self.__create_time:
+            return self.__create_time
         return self.__file_data.get_ctime()
 
     def __repr__(self):
@@ -375,13 +398,14 @@ class TemplateManager:
     """Template manager maintains the database of the installed templates and
        associated file extensions."""
 
-    __filetype_registry = {}
-    __registered_templates = []
     __template_location = ""
-    __registry_updated = False
 
     def __init__(self, template_file_location):
         """Initializes the template manager and database"""
+        self.__filetype_registry = {}
+        self.__registered_templates = []
+        self.__registry_updated = False
+        self.__registry_stamp = None
         self.__template_location = template_file_location
         self.load_registry_file()
 
@@ -484,10 +508,19 @@ class TemplateManager:
     def create_registry_file(self):
         """
         Creates a new template registry database
+        If another process created the registry in the meantime, it is loaded
+        instead.
         """
-        for template_file in list_dir_visible(self.__template_location):
-            self.get_template_metadata(template_file)
-        self.write_registry_file()
+        lock = self.lock_registry()
+        try:
+            if self.get_registry_stamp():
+                self.read_registry_file()
+                return
+            for template_file in list_dir_visible(self.__template_location):
+                self.get_template_metadata(template_file)
+            self.write_registry_file()
+        finally:
+            self.unlock_registry(lock)
 
     def update_registry_file(self):
         """Unimplemented
@@ -495,17 +528,72 @@ class TemplateManager:
         Inserts new registry templates
         Removes deleted registry templates
         Updates modified registry templates
+        If another process updated the registry since it was loaded, its
+        update is loaded instead of rebuilding the registry again. Nothing is
+        rebuilt when no template changed since the registry was written.
+        """
+        lock = self.lock_registry()
+        try:
+            stamp = self.get_registry_stamp()
+            if stamp and stamp != self.__registry_stamp:
+                self.read_registry_file()
+                return
+            if stamp and not self.templates_changed():
+                return
+            self.add_new_templates()
+            self.remove_deleted_templates()
+            self.update_modified_templates()
+            self.write_registry_file()
+        finally:
+            self.unlock_registry(lock)
+
+    def lock_registry(self):
+        """
+        Takes the advisory lock guarding registry updates
+        Readers never take the lock, the registry is replaced atomically.
+        """
+        lock = open(self.__template_location + "/.file_types.db.lock", "a")
+        if fcntl:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        return lock
+
+    def unlock_registry(self, lock):
+        """Releases the registry lock"""
+        if fcntl:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        lock.close()
+
+    def templates_changed(self):
         """
-        self.add_new_templates()
-        self.remove_deleted_templates()
-        self.update_modified_templates()
-        self.write_registry_file()
+        Returns true if the template folder changed after the registry was
+        written. Adding or removing a template changes the folder's mtime,
+        editing one changes its own mtime.
+        """
+        try:
+            registry_mtime = os.stat(
+                self.__template_location + "/.file_types.db").st_mtime_ns
+            if os.stat(self.__template_location).st_mtime_ns > registry_mtime:
+                return True
+            for template_file in list_dir_visible(self.__template_location):
+                if os.stat(self.__template_location + "/" +
+                           template_file).st_mtime_ns > registry_mtime:
+                    return True
+        except OSError:
+            return True
+        return False
+
+    def get_registry_stamp(self):
+        """Returns what identifies the current registry file, None if absent"""
+        try:
+            stat = os.stat(self.__template_location + "/.file_types.db")
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
     def load_registry_file(self):
         """
         Loads the contents of the registry into the class members
         """
-        registry_location = self.__template_location + "/.file_types.db"
         try:
             contains_registry = ".file_types.db" in os.listdir(
                 self.__template_location)
@@ -521,9 +609,17 @@ class TemplateManager:
             # Don't update the registry here, instead we will run the updates
             # when a template is not in our database
             # print ("DEBUG > Load Registry")
-            registry_contents = pickle.load(open(registry_location, "rb"))
-            self.__registered_templates = registry_contents[0]
-            self.__filetype_registry = registry_contents[1]
+            self.read_registry_file()
+
+    def read_registry_file(self):
+        """Reads the registry written by this or another process"""
+        registry_location = self.__template_location + "/.file_types.db"
+        with open(registry_location, "rb") as registry_file:
+            stat = os.fstat(registry_file.fileno())
+            registry_contents = pickle.load(registry_file)
+        self.__registered_templates = registry_contents[0]
+        self.__filetype_registry = registry_contents[1]
+        self.__registry_stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
     def search_templates(self, file_extension):
         """Finds the corresponding template file for a given extension"""
@@ -551,9 +647,652 @@ class TemplateManager:
         lst = []
         lst.append(self.__registered_templates)
         lst.append(self.__filetype_registry)
-        registry_file = open(registry_location, "wb")
+        # Write next to the registry and swap it in, so that readers never
+        # see a partially written registry
+        tmp_location = "{0}.{1}.tmp".format(registry_location,
+                                            random_name_generator())
+        registry_file = open(tmp_location, "wb")
         pickle.dump(lst, registry_file)
         registry_file.close()
+        os.replace(tmp_location, registry_location)
+        self.__registry_stamp = self.get_registry_stamp()
+
+
+# Result Stream
+#
+# Collects the outcome of every processed file. Each result is written to an
+# optional JSONL sink as soon as it is emitted, only the aggregate counters are
+# kept in memory.
+class ResultStream:
+    """Emits structured result records and reports progress of a run"""
+
+    progress_interval = 0.5
+
+    def __init__(self, sink_location=None, progress=None, shard=None,
+                 budget=None):
+        """Creates a new result stream, writing records to sink_location"""
+        self.__shard = shard
+        self.__budget = budget
+        self.__sink = None
+        if sink_location:
+            self.__sink = open(sink_location, "w")
+        if progress is None:
+            progress = sys.stderr.isatty()
+        self.__progress = progress
+        self.__actions = {}
+        self.__files = 0
+        self.__bytes = 0
+        self.__errors = 0
+        self.__start_time = time.time()
+        self.__last_progress = 0.0
+        self.__last_flush = self.__start_time
+
+    def emit(self, record):
+        """Records the result of a single file"""
+        self.__files += 1
+        self.__actions[record["action"]] = self.__actions.get(
+            record["action"], 0) + 1
+        self.__bytes += record["bytes"]
+        if record["error"]:
+            self.__errors += 1
+        if self.__sink:
+            self.__sink.write(json.dumps(record) + "\n")
+            # Flush on the progress throttle, so that a killed run loses at
+            # most the last interval and the sink can be followed live
+            now = time.time()
+            if now - self.__last_flush >= self.progress_interval:
+                self.__sink.flush()
+                self.__last_flush = now
+        self.show_progress()
+
+    def show_progress(self, force=False):
+        """Writes a throttled progress line to the terminal"""
+        now = time.time()
+        if not self.__progress:
+            return
+        if not force and now - self.__last_progress < self.progress_interval:
+            return
+        self.__last_progress = now
+        elapsed = now - self.__start_time
+        rate = self.__files / elapsed if elapsed > 0 else 0.0
+        sys.stderr.write("\r{0} files, {1} errors ({2:.1f} files/s)".format(
+            self.__files, self.__errors, rate))
+        sys.stderr.flush()
+
+    def get_error_count(self):
+        """Returns the number of files that failed"""
+        return self.__errors
+
+    def summary(self):
+        """Returns the aggregate results of the run"""
+        shard = None
+        if self.__shard:
+            shard = "{0}/{1}".format(*self.__shard)
+        summary = {"files": self.__files,
+                   "actions": dict(self.__actions),
+                   "bytes": self.__bytes,
+                   "errors": self.__errors,
+                   "duration": time.time() - self.__start_time,
+                   "shard": shard}
+        if self.__budget:
+            summary["io"] = self.__budget.stats()
+        return summary
+
+    def close(self):
+        """
+        Flushes the sink and prints the final summary
+        The summary is also written as the last record of the sink, so that
+        reports of several shards can be merged later on.
+        """
+        summary = self.summary()
+        if self.__progress:
+            self.show_progress(force=True)
+            sys.stderr.write("\n")
+        if self.__sink:
+            self.__sink.write(json.dumps({"summary": summary}) + "\n")
+            self.__sink.close()
+            self.__sink = None
+        print_summary(summary)
+
+
+def print_summary(summary):
+    """Prints the aggregate results of a run"""
+    duration = summary["duration"]
+    rate = summary["files"] / duration if duration > 0 else 0.0
+    print("Processed {0} files in {1:.2f}s ({2:.1f} files/s)".format(
+        summary["files"], duration, rate))
+    for action in sorted(summary["actions"]):
+        print("  {0}: {1}".format(action, summary["actions"][action]))
+    print("Bytes written: {0}".format(summary["bytes"]))
+    print("Errors: {0}".format(summary["errors"]))
+    io = summary.get("io")
+    if io:
+        print("I/O budget: {0} bytes/s, {1} files/s".format(
+            io["bytes_limit"] or "unlimited", io["files_limit"] or "unlimited"))
+        print("  used: {0:.0f} bytes/s, {1:.1f} files/s, throttled {2:.2f}s".
+              format(io["bytes_rate"], io["files_rate"], io["throttled"]))
+
+
+def merge_results(report_locations, sink_location=None):
+    """
+    Combines the result reports of several shards into a single summary
+    Records are copied to sink_location when given, followed by the merged
+    summary if the reports make up a complete set of shards. Returns the merged
+    summary, or None if the set is incomplete.
+    """
+    merged = {"files": 0, "actions": {}, "bytes": 0, "errors": 0,
+              "duration": 0.0, "shard": None}
+    shards = set()
+    shard_count = None
+    complete = True
+    sink = None
+    if sink_location:
+        sink = open(sink_location, "w")
+    for report_location in report_locations:
+        summary = None
+        try:
+            with open(report_location, "r") as report:
+                for line in report:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if "summary" in record:
+                        summary = record["summary"]
+                    elif sink:
+                        sink.write(line)
+        except IOError:
+            print("Error: Could not read report {0}".format(report_location))
+            complete = False
+            continue
+        except ValueError:
+            # The last line is torn when a shard was killed mid-run
+            print("Error: Report {0} has a malformed record".format(
+                report_location))
+            complete = False
+            continue
+        if not summary:
+            print("Error: Report {0} is incomplete".format(report_location))
+            complete = False
+            continue
+        try:
+            files = summary["files"]
+            nbytes = summary["bytes"]
+            errors = summary["errors"]
+            duration = summary["duration"]
+            actions = dict(summary["actions"])
+            shard = summary["shard"]
+        except (KeyError, TypeError, ValueError):
+            print("Error: Report {0} has a malformed summary".format(
+                report_location))
+            complete = False
+            continue
+        merged["files"] += files
+        merged["bytes"] += nbytes
+        merged["errors"] += errors
+        # Shards run side by side, so the slowest one determines the duration
+        merged["duration"] = max(merged["duration"], duration)
+        for action, count in actions.items():
+            merged["actions"][action] = merged["actions"].get(action, 0) + count
+        if shard:
+            try:
+                (index, count) = parse_shard(shard)
+            except (argparse.ArgumentTypeError, AttributeError):
+                print("Error: Report {0} has an invalid shard {1!r}".format(
+                    report_location, shard))
+                complete = False
+                continue
+            if shard_count is None:
+                shard_count = count
+            if count != shard_count:
+                print("Error: Report {0} is shard {1}, expected a shard of {2}".
+                      format(report_location, shard, shard_count))
+                complete = False
+            elif index in shards:
+                print("Error: Shard {0} is reported more than once".format(
+                    shard))
+                complete = False
+            shards.add(index)
+    if shard_count is not None:
+        missing = sorted(set(range(1, shard_count + 1)) - shards)
+        if missing:
+            print("Error: Missing reports for shards {0}".format(
+                ", ".join("{0}/{1}".format(i, shard_count) for i in missing)))
+            complete = False
+    if sink:
+        # Without a summary record the merged report is itself incomplete
+        if complete:
+            sink.write(json.dumps({"summary": merged}) + "\n")
+        sink.close()
+    if not complete:
+        return None
+    return merged
+
+
+# Patch Writer
+#
+# Streams the header insertions of a run as a single unified diff, instead of
+# rewriting the files. Only the lines around the insertion point are read.
+class PatchWriter:
+    """Writes a git apply compatible patch adding the headers"""
+
+    context_lines = 3
+
+    def __init__(self, patch_location, root):
+        """
+        Opens the patch
+        Paths are made relative to the top level of the git repository holding
+        the project root, which is where git apply expects them to start. Outside
+        of git they are relative to the project root.
+        """
+        self.__root = os.path.realpath(git_toplevel(root) or root)
+        self.__patch = open(patch_location, "w")
+
+    def add_header(self, src_file, template, head):
+        """
+        Writes the hunk inserting the header into a source file
+        Returns the size of the written diff, 0 if the file would not change
+        """
+        head_lines = head.splitlines(True)
+        if not head_lines:
+            return 0
+        template_include = template.get_include()
+        before = []
+        after = []
+        offset = 0
+        with open(src_file, "r", newline="") as s:
+            if template.is_include_top():
+                for line in s:
+                    if not is_preamble_line(line, template_include):
+                        after.append(line)
+                        break
+                    offset += 1
+                    before = (before + [line])[-self.context_lines:]
+                else:
+                    # Only include lines, insert_header writes no header
+                    return 0
+            for line in s:
+                if len(after) >= self.context_lines:
+                    break
+                after.append(line)
+
+        start = offset - len(before) + 1
+        old_count = len(before) + len(after)
+        relpath = relative_path(os.path.realpath(src_file), self.__root)
+        diff = "diff --git a/{0} b/{0}\n--- a/{0}\n+++ b/{0}\n".format(relpath)
+        diff += "@@ -{0},{1} +{2},{3} @@\n".format(
+            start if old_count else 0, old_count, start,
+            old_count + len(head_lines))
+        diff += "".join(" " + line for line in before)
+        diff += "".join("+" + line for line in head_lines)
+        for line in after:
+            diff += " " + line
+            if not line.endswith("\n"):
+                diff += "\n\\ No newline at end of file\n"
+        self.__patch.write(diff)
+        return len(diff)
+
+    def close(self):
+        """Closes the patch"""
+        self.__patch.close()
+
+
+# Journal
+#
+# Records the files a run has completed, so that an interrupted run can be
+# resumed without applying headers twice. Entries are flushed in batches.
+class Journal:
+    """Journal of completed files with their size and modification time"""
+
+    batch_size = 100
+
+    def __init__(self, journal_location, resume=False):
+        """Opens the journal, loading the completed files when resuming"""
+        self.__completed = {}
+        self.__pending = []
+        self.__resume = resume
+        if resume and os.path.exists(journal_location):
+            with open(journal_location, "r") as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may be torn if the run was killed
+                        continue
+                    self.__completed[entry["path"]] = (entry["size"],
+                                                       entry["mtime"])
+        self.__journal = open(journal_location, "a" if resume else "w")
+
+    def is_resumed(self):
+        """
+        Returns true if the journal continues an interrupted run
+        Files written after the last flush of that run are not journaled, so
+        they have to be checked for an existing header.
+        """
+        return self.__resume
+
+    def is_completed(self, filepath):
+        """
+        Returns true if the file was completed by a previous run
+        The file must not have changed since, judged by its size and mtime.
+        """
+        entry = self.__completed.get(os.path.abspath(filepath))
+        if not entry:
+            return False
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return False
+        return entry == (stat.st_size, stat.st_mtime_ns)
+
+    def record(self, filepath):
+        """Adds a completed file to the journal"""
+        stat = os.stat(filepath)
+        self.__pending.append(json.dumps({"path": os.path.abspath(filepath),
+                                          "size": stat.st_size,
+                                          "mtime": stat.st_mtime_ns}) + "\n")
+        if len(self.__pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the pending entries to disk"""
+        if not self.__pending:
+            return
+        self.__journal.write("".join(self.__pending))
+        self.__journal.flush()
+        os.fsync(self.__journal.fileno())
+        self.__pending = []
+
+    def close(self):
+        """Flushes and closes the journal"""
+        self.flush()
+        self.__journal.close()
+
+
+# I/O Budget
+#
+# Token buckets limiting how many bytes and files the rewrite pipeline handles
+# per second. The limits can be changed while running through a control file,
+# which is re-read on SIGHUP or whenever it is modified.
+class IOBudget:
+    """Throttles the pipeline to a number of bytes and files per second"""
+
+    poll_interval = 1.0
+
+    def __init__(self, bytes_limit=None, files_limit=None,
+                 control_location=None):
+        """Creates a budget, a limit of None or 0 means unlimited"""
+        self.__limits = {"bytes": bytes_limit, "files": files_limit}
+        # Allow a burst of up to one second worth of work
+        self.__tokens = {"bytes": bytes_limit or 0, "files": files_limit or 0}
+        self.__consumed = {"bytes": 0, "files": 0}
+        self.__throttled = 0.0
+        self.__start_time = time.monotonic()
+        self.__last_refill = self.__start_time
+        self.__control_location = control_location
+        self.__control_mtime = None
+        self.__last_poll = 0.0
+        self.__reload_requested = control_location is not None
+
+    def request_reload(self, signum=None, frame=None):
+        """Re-reads the control file before the next file, usable as handler"""
+        self.__reload_requested = True
+
+    def reload(self):
+        """
+        Reads the limits from the control file
+        Each line is of the form bytes=N or files=N, 0 disables the limit.
+        """
+        try:
+            self.__control_mtime = os.path.getmtime(self.__control_location)
+            with open(self.__control_location, "r") as control:
+                limits = {}
+                for line in control:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    (kind, value) = line.split("=", 1)
+                    kind = kind.strip()
+                    if kind not in self.__limits:
+                        raise ValueError("unknown limit " + kind)
+                    limits[kind] = float(value) or None
+                    if limits[kind] is not None and limits[kind] < 0:
+                        raise ValueError("negative limit " + kind)
+        except (IOError, ValueError) as e:
+            print("Error: Could not read I/O control file {0}: {1}".format(
+                self.__control_location, e))
+            return
+        self.__refill()
+        for kind, limit in limits.items():
+            if limit and not self.__limits[kind]:
+                # A newly limited bucket starts full, like a new budget
+                self.__tokens[kind] = limit
+            elif limit:
+                self.__tokens[kind] = min(self.__tokens[kind], limit)
+            else:
+                self.__tokens[kind] = 0
+            self.__limits[kind] = limit
+
+    def __check_control(self):
+        """Reloads the control file when requested or modified"""
+        if not self.__control_location:
+            return
+        now = time.monotonic()
+        if not self.__reload_requested and \
+                now - self.__last_poll >= self.poll_interval:
+            self.__last_poll = now
+            try:
+                modified = os.path.getmtime(self.__control_location)
+            except OSError:
+                modified = self.__control_mtime
+            self.__reload_requested = modified != self.__control_mtime
+        if self.__reload_requested:
+            self.__reload_requested = False
+            self.reload()
+
+    def __refill(self):
+        """Adds the tokens earned since the last refill"""
+        now = time.monotonic()
+        elapsed = now - self.__last_refill
+        self.__last_refill = now
+        for kind, limit in self.__limits.items():
+            if limit:
+                self.__tokens[kind] = min(limit,
+                                          self.__tokens[kind] + elapsed * limit)
+
+    def consume(self, nbytes, nfiles=1):
+        """Takes tokens for the work, sleeping until the budget allows it"""
+        self.__check_control()
+        self.__consumed["bytes"] += nbytes
+        self.__consumed["files"] += nfiles
+        self.__refill()
+        wait = 0.0
+        for (kind, amount) in (("bytes", nbytes), ("files", nfiles)):
+            limit = self.__limits[kind]
+            # Unlimited buckets are left alone, so that they carry no debt
+            # once a limit is set
+            if not limit:
+                continue
+            self.__tokens[kind] -= amount
+            if self.__tokens[kind] < 0:
+                wait = max(wait, -self.__tokens[kind] / limit)
+        if wait > 0:
+            time.sleep(wait)
+            self.__throttled += wait
+
+    def stats(self):
+        """Returns the configured limits and the achieved throughput"""
+        elapsed = time.monotonic() - self.__start_time
+        if elapsed <= 0:
+            elapsed = 1.0
+        return {"bytes_limit": self.__limits["bytes"],
+                "files_limit": self.__limits["files"],
+                "bytes": self.__consumed["bytes"],
+                "files": self.__consumed["files"],
+                "bytes_rate": self.__consumed["bytes"] / elapsed,
+                "files_rate": self.__consumed["files"] / elapsed,
+                "throttled": self.__throttled}
+
+
+class BudgetReader:
+    """
+    File object charging everything read through it to an I/O budget
+    Used for the members that are copied, so that large archives are throttled
+    as they stream instead of all at once.
+    """
+
+    def __init__(self, fileobj, budget):
+        """Wraps an opened file object"""
+        self.__fileobj = fileobj
+        self.__budget = budget
+
+    def read(self, size=-1):
+        """Reads from the file, charging the read and the matching write"""
+        data = self.__fileobj.read(size)
+        if data:
+            self.__budget.consume(2 * len(data), 0)
+        return data
+
+
+def parse_limit(value):
+    """Parses an I/O limit, 0 disables the limit"""
+    try:
+        limit = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid limit '{0}', expected a number".format(value))
+    if limit < 0:
+        raise argparse.ArgumentTypeError(
+            "invalid limit '{0}', expected a value >= 0".format(value))
+    return limit
+
+
+def glob_to_regex(pattern):
+    """Translates a .gitignore style glob into a regular expression"""
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            regex += "/.*"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            char_class = pattern[i + 1:end].replace("\\", "\\\\")
+            if char_class.startswith("!"):
+                char_class = "^" + char_class[1:]
+            regex += "[" + char_class + "]"
+            i = end + 1
+        elif pattern[i] == "\\" and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+# Path Filter
+#
+# Decides which files and directories are left out of a run. The rules follow
+# the .gitignore syntax and are compiled into one combined expression, so that
+# matching a path costs a single regex match no matter how many rules exist.
+class PathFilter:
+    """Compiled set of .gitignore style exclude and include rules"""
+
+    def __init__(self, root):
+        """Creates an empty filter for paths relative to the project root"""
+        self.__root = root
+        self.__rules = []
+        self.__file_matcher = None
+        self.__directory_matcher = None
+
+    def add_pattern(self, pattern, base=""):
+        """
+        Adds a single .gitignore style rule
+        Patterns containing a slash are anchored to base, a leading ! turns the
+        rule into an include and a trailing slash only matches directories.
+        """
+        pattern = pattern.rstrip("\n\r ")
+        if not pattern or pattern.startswith("#"):
+            return
+        negate = pattern.startswith("!")
+        if negate:
+            pattern = pattern[1:]
+        directory_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        if not pattern:
+            return
+        regex = glob_to_regex(pattern.lstrip("/"))
+        if "/" not in pattern:
+            regex = "(?:.*/)?" + regex
+        if base:
+            regex = re.escape(base.rstrip("/")) + "/" + regex
+        self.__rules.append((regex, negate, directory_only))
+        self.__file_matcher = None
+        self.__directory_matcher = None
+
+    def add_patterns_file(self, location):
+        """Adds every rule of a .gitignore style file, relative to its folder"""
+        base = relative_path(os.path.dirname(os.path.abspath(location)),
+                             self.__root)
+        if base == ".":
+            base = ""
+        with open(location, "r") as patterns:
+            for line in patterns:
+                self.add_pattern(line, base)
+
+    def compile(self):
+        """
+        Combines the rules into a file and a directory matcher
+        Later rules take precedence, so they are tried first.
+        """
+        self.__file_matcher = self.__compile_rules(
+            [i for i, rule in enumerate(self.__rules) if not rule[2]])
+        self.__directory_matcher = self.__compile_rules(
+            list(range(len(self.__rules))))
+
+    def __compile_rules(self, rule_indices):
+        """Builds an expression with one named group per rule"""
+        if not rule_indices:
+            return None
+        return re.compile("|".join(
+            "(?P<r{0}>{1})".format(i, self.__rules[i][0])
+            for i in reversed(rule_indices)))
+
+    def is_excluded(self, relpath, is_directory=False):
+        """Returns true if the path relative to the project root is excluded"""
+        if self.__directory_matcher is None:
+            self.compile()
+        if is_directory:
+            matcher = self.__directory_matcher
+        else:
+            matcher = self.__file_matcher
+        if not matcher:
+            return False
+        match = matcher.fullmatch(relpath)
+        if not match:
+            return False
+        return not self.__rules[int(match.lastgroup[1:])][1]
+
+    def is_path_excluded(self, path):
+        """Returns true if the file, or any folder containing it, is excluded"""
+        relpath = relative_path(path, self.__root)
+        parts = relpath.split("/")
+        for i in range(1, len(parts)):
+            if self.is_excluded("/".join(parts[:i]), True):
+                return True
+        return self.is_excluded(relpath, os.path.isdir(path))
 
 
 # String pattern
@@ -657,6 +1396,106 @@ def read_config(fileProperty, current_directory):
         exit()
 
 
+def unique_files(paths):
+    """
+    Yields each path given on the command line once, in the order given
+    Paths inside a folder that is given as well are dropped, walking the folder
+    yields them already. Only the arguments are remembered, not walked files.
+    """
+    paths = list(paths)
+    folders = set(os.path.abspath(path) for path in paths
+                  if os.path.isdir(path))
+    seen = set()
+    for path in paths:
+        filepath = os.path.abspath(path)
+        if filepath in seen:
+            continue
+        seen.add(filepath)
+        parent = os.path.dirname(filepath)
+        while parent not in folders and parent != os.path.dirname(parent):
+            parent = os.path.dirname(parent)
+        if parent not in folders:
+            yield path
+
+
+def walk_files(paths, path_filter, root, accept=None, shard=None):
+    """
+    Yields the files to process
+    Folders are walked recursively, excluded folders are pruned before they are
+    listed. Files outside the shard are dropped before anything else is done
+    with them, walked files are only yielded when accept returns true for them.
+    """
+    for path in paths:
+        if path_filter.is_path_excluded(path):
+            continue
+        if not os.path.isdir(path):
+            if not shard or in_shard(relative_path(path, root), shard):
+                yield path
+            continue
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            relpath = relative_path(dirpath, root)
+            dirnames[:] = sorted(
+                d for d in dirnames
+                if not path_filter.is_excluded(
+                    posix_join(relpath, d), True))
+            for fname in sorted(filenames):
+                file_relpath = posix_join(relpath, fname)
+                if path_filter.is_excluded(file_relpath):
+                    continue
+                if shard and not in_shard(file_relpath, shard):
+                    continue
+                filepath = os.path.join(dirpath, fname)
+                if accept is None or accept(filepath):
+                    yield filepath
+
+
+def posix_join(relpath, name):
+    """Joins a name to a path relative to the project root"""
+    if relpath == ".":
+        return name
+    return relpath + "/" + name
+
+
+def parse_shard(value):
+    """Parses a shard specification of the form K/N, with 1 <= K <= N"""
+    try:
+        (index, count) = [int(v) for v in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid shard '{0}', expected K/N".format(value))
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(
+            "invalid shard '{0}', expected 1 <= K <= N".format(value))
+    return (index, count)
+
+
+def relative_path(path, root):
+    """Returns the path relative to the project root, using / as separator"""
+    return os.path.relpath(os.path.abspath(path),
+                           os.path.abspath(root)).replace(os.sep, "/")
+
+
+def in_shard(relpath, shard):
+    """
+    Returns true if the file belongs to the given shard
+    Files are partitioned by a stable hash of their path relative to the
+    project root, so every machine computes the same partition.
+    """
+    (index, count) = shard
+    digest = hashlib.sha1(relpath.encode("utf-8"))
+    return int(digest.hexdigest()[:16], 16) % count == index - 1
+
+
+def git_toplevel(directory):
+    """Returns the top level of the git repository holding the directory"""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--show-toplevel"], cwd=directory,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
 def is_root(directory):
     path = os.path.abspath(directory)
     if path == "/":
@@ -665,15 +1504,307 @@ def is_root(directory):
         return False
 
 
+def is_preamble_line(line, template_include):
+    """Returns true if the line stays above the header of an include template"""
+    return (template_include in line) or (line is string.whitespace)
+
+
+def insert_header(lines, template, head):
+    """Yields the lines of a source file with the header put in place"""
+    template_include = template.get_include()
+
+    header_written = False
+    if not template.is_include_top():
+        yield head
+        header_written = True
+        for line in lines:
+            yield line
+    else:
+        for line in lines:
+            if is_preamble_line(line, template_include):
+                pass
+            elif not header_written:
+                yield head
+                header_written = True
+            yield line
+
+
+def apply_header(src_file, template, head):
+    """Writes the header into a source file, returns the size of the result"""
+    # Make the backup hidden
+    tmp_name = "."
+    tmp_name += random_name_generator()
+    tmp_name += ".bak"
+
+    with open(src_file, 'r') as s:
+        with open(tmp_name, 'w') as d:
+            for line in insert_header(s, template, head):
+                d.write(line)
+
+    # Put the file back where it goes
+    os.rename(tmp_name, src_file)
+    return os.path.getsize(src_file)
+
+
+def has_header(src_file, template, username, email):
+    """
+    Returns true if the file already has the header at its insertion point
+    The date is left out of the comparison, it comes from the ctime of the file
+    which the rewrite itself changes. Only the preamble and the lines the
+    header would take are read.
+    """
+    date_marker = "\0DATE\0"
+    head = template.generate_header(Header(username, email, src_file,
+                                           date_marker))
+    head_patterns = [
+        re.compile(".*".join(re.escape(part)
+                             for part in line.split(date_marker)))
+        for line in head.splitlines(True)]
+    if not head_patterns:
+        return False
+    template_include = template.get_include()
+    with open(src_file, "r") as s:
+        line = s.readline()
+        if template.is_include_top():
+            while line and is_preamble_line(line, template_include):
+                line = s.readline()
+        for pattern in head_patterns:
+            if not line or not pattern.fullmatch(line):
+                return False
+            line = s.readline()
+    return True
+
+
+def process_file(src_file, username, email, templates, budget=None,
+                 patch=None, skip_existing=False):
+    """
+    Applies the matching template to a source file
+    With a patch writer the change is added to the patch instead of the file.
+    With skip_existing, files that already have the header are left alone.
+    Returns the result record of the file, failures are reported in the record
+    instead of aborting the run
+    """
+    start_time = time.time()
+    record = {"path": src_file, "template": None, "action": "error",
+              "bytes": 0, "duration": 0.0, "error": None}
+    try:
+        heading = Header(username, email, src_file)
+        template = templates.search_templates(heading.get_extension())
+        if not template:
+            record["action"] = "unsupported"
+            if heading.get_extension() is None:
+                record["error"] = "No file extension"
+            else:
+                record["error"] = "Template for {0} not found".format(
+                    heading.get_extension())
+        else:
+            record["template"] = template.get_file().get_file()
+            head = template.generate_header(heading)
+            if skip_existing and has_header(src_file, template, username,
+                                            email):
+                record["action"] = "existing"
+            elif patch:
+                record["bytes"] = patch.add_header(src_file, template, head)
+                record["action"] = "patched" if record["bytes"] else \
+                    "unchanged"
+                if budget:
+                    budget.consume(record["bytes"])
+            else:
+                if budget:
+                    # The file is read once and written back with its header
+                    budget.consume(2 * os.path.getsize(src_file) + len(head))
+                record["bytes"] = apply_header(src_file, template, head)
+                record["action"] = "written"
+    except Exception as e:
+        record["error"] = "{0}: {1}".format(type(e).__name__, e)
+    record["duration"] = time.time() - start_time
+    return record
+
+
+def process_member(member_path, data, mtime, username, email, templates,
+                   budget=None):
+    """
+    Applies the matching template to the contents of an archive member
+    Returns the new contents and the result record, or None for both if the
+    member has no template and should be copied as is
+    """
+    start_time = time.time()
+    heading = Header(username, email, member_path,
+                     time.strftime("%b %d %Y", time.localtime(mtime)))
+    template = templates.search_templates(heading.get_extension())
+    if not template:
+        return (None, None)
+    record = {"path": member_path, "template": template.get_file().get_file(),
+              "action": "error", "bytes": 0, "duration": 0.0, "error": None}
+    try:
+        text = data.decode("utf-8")
+        head = template.generate_header(heading)
+        if budget:
+            budget.consume(2 * len(data) + len(head))
+        data = "".join(insert_header(text.splitlines(True), template,
+                                     head)).encode("utf-8")
+        record["bytes"] = len(data)
+        record["action"] = "written"
+    except Exception as e:
+        record["error"] = "{0}: {1}".format(type(e).__name__, e)
+        data = None
+    record["duration"] = time.time() - start_time
+    return (data, record)
+
+
+def tar_write_mode(archive_location):
+    """Returns the streaming tarfile mode matching the archive extension"""
+    for (extensions, mode) in (((".tar.gz", ".tgz"), "w|gz"),
+                               ((".tar.bz2", ".tbz2"), "w|bz2"),
+                               ((".tar.xz", ".txz"), "w|xz")):
+        if archive_location.endswith(extensions):
+            return mode
+    return "w|"
+
+
+def process_tar(src_location, dest_location, username, email, templates,
+                results, budget=None):
+    """Streams a tar archive, rewriting the members that have a template"""
+    with tarfile.open(src_location, "r|*") as source, \
+            tarfile.open(dest_location, tar_write_mode(dest_location)) as dest:
+        for member in source:
+            if not member.isfile():
+                dest.addfile(member)
+                continue
+            fileobj = source.extractfile(member)
+            record = None
+            if templates.search_templates(
+                    os.path.splitext(member.name)[1][1:]):
+                original = fileobj.read()
+                (data, record) = process_member(
+                    os.path.join(src_location, member.name), original,
+                    member.mtime, username, email, templates, budget)
+                if data is None:
+                    data = original
+                member = copy.copy(member)
+                member.size = len(data)
+                fileobj = io.BytesIO(data)
+            elif budget:
+                fileobj = BudgetReader(fileobj, budget)
+            dest.addfile(member, fileobj)
+            if record:
+                results.emit(record)
+
+
+def process_zip(src_location, dest_location, username, email, templates,
+                results, budget=None):
+    """
+    Copies a zip archive, rewriting the members that have a template
+    Other members keep their contents and compression method, but are
+    recompressed, as zipfile can not copy compressed data as is.
+    """
+    with zipfile.ZipFile(src_location, "r") as source, \
+            zipfile.ZipFile(dest_location, "w") as dest:
+        dest.comment = source.comment
+        for member in source.infolist():
+            if member.is_dir():
+                dest.writestr(member, b"")
+                continue
+            if templates.search_templates(
+                    os.path.splitext(member.filename)[1][1:]):
+                original = source.read(member)
+                (data, record) = process_member(
+                    os.path.join(src_location, member.filename), original,
+                    time.mktime(member.date_time + (0, 0, -1)), username,
+                    email, templates, budget)
+                dest.writestr(member, original if data is None else data)
+                results.emit(record)
+            else:
+                with source.open(member) as s, dest.open(member, "w") as d:
+                    shutil.copyfileobj(BudgetReader(s, budget) if budget
+                                       else s, d)
+
+
+def process_archive(src_location, dest_location, username, email, templates,
+                    results, budget=None):
+    """
+    Writes a copy of a tar or zip archive with headers applied to its members
+    Only one member is held in memory at a time, the others are streamed
+    """
+    try:
+        if os.path.abspath(src_location) == os.path.abspath(dest_location):
+            raise ValueError("the archive can not be rewritten in place")
+        if zipfile.is_zipfile(src_location):
+            process_zip(src_location, dest_location, username, email,
+                        templates, results, budget)
+        else:
+            process_tar(src_location, dest_location, username, email,
+                        templates, results, budget)
+    except (IOError, ValueError, tarfile.TarError, zipfile.BadZipFile) as e:
+        results.emit({"path": src_location, "template": None,
+                      "action": "error", "bytes": 0, "duration": 0.0,
+                      "error": "{0}: {1}".format(type(e).__name__, e)})
+
+
+def run_files(paths, username, email, templates, results, path_filter, root,
+              shard=None, journal=None, budget=None, patch=None):
+    """
+    Runs the pipeline over the given files and folders
+    Files are streamed one at a time from the walk into the result stream.
+    """
+    def has_template(src_file):
+        extension = FileProperty(src_file).get_extension()
+        return templates.search_templates(extension) is not None
+
+    for src_file in walk_files(unique_files(paths), path_filter, root,
+                               has_template, shard):
+        if journal and journal.is_completed(src_file):
+            results.emit({"path": src_file, "template": None,
+                          "action": "journaled", "bytes": 0,
+                          "duration": 0.0, "error": None})
+            continue
+        record = process_file(src_file, username, email, templates, budget,
+                              patch, journal and journal.is_resumed())
+        if journal and record["action"] in ("written", "existing"):
+            journal.record(src_file)
+        results.emit(record)
+
+
 def main():
     args = argparse.ArgumentParser(description="Add headings to source files.")
-    args.add_argument('files', nargs="+", help="List of files to add\ headings to.")
+    args.add_argument('files', nargs="*", help="List of files to add\ headings to.")
     args.add_argument('-u', '--username', help="Specify a user name to place in the headings.")
     args.add_argument('-e', '--email', help="Specify an email address for the user.")
     args.add_argument('-t', '--templates', help="Specify the directory containing the templates.")
+    args.add_argument('-r', '--results', help="Write a JSONL result record for every processed file.")
+    args.add_argument('-x', '--exclude', action="append", dest="filters", metavar="PATTERN", help="Skip files and folders matching a .gitignore style pattern.")
+    args.add_argument('--include', action="append", dest="filters", type=lambda p: "!" + p, metavar="PATTERN", help="Process files matching the pattern, even if they were excluded.")
+    args.add_argument('--exclude-from', action="append", default=[], metavar="FILE", help="Read exclude patterns from a .gitignore style file.")
+    args.add_argument('-j', '--journal', metavar="FILE", help="Record completed files, so that an interrupted run can be resumed.")
+    args.add_argument('--resume', action="store_true", help="Skip the files completed according to the journal.")
+    args.add_argument('--io-limit', type=parse_limit, metavar="BYTES", help="Limit the bytes read and written per second.")
+    args.add_argument('--files-limit', type=parse_limit, metavar="FILES", help="Limit the files rewritten per second.")
+    args.add_argument('--io-control', metavar="FILE", help="Read the I/O limits from a control file, re-read on SIGHUP or change.")
+    args.add_argument('-a', '--archive', nargs=2, metavar=("SRC", "DEST"), help="Apply headers to the members of a tar or zip archive, writing a new archive.")
+    args.add_argument('-p', '--emit-patch', metavar="FILE", help="Write a unified diff of the headers to FILE instead of changing the files.")
+    args.add_argument('--shard', type=parse_shard, metavar="K/N", help="Only process the K-th of N shards of the files.")
+    args.add_argument('--merge', nargs="+", metavar="REPORT", help="Merge the result reports of several shards.")
     args.add_argument('--version', action="version", version="%(prog)s 1.1")
+    parser = args
     args = vars(args.parse_args())
 
+    if args['merge']:
+        summary = merge_results(args['merge'], args['results'])
+        if not summary:
+            exit(1)
+        print_summary(summary)
+        if summary["errors"]:
+            exit(1)
+        return
+    if not args['files'] and not args['archive']:
+        parser.error("the following arguments are required: files")
+    if args['resume'] and not args['journal']:
+        parser.error("--resume requires --journal")
+    if args['emit_patch'] and args['archive']:
+        parser.error("--emit-patch can not be combined with --archive")
+    if args['shard'] and args['archive']:
+        parser.error("--shard can not be combined with --archive")
+
     filename = ".license.config"
     directory = "./"
 
@@ -815,52 +1946,53 @@ def main():
                 email = emailT
             if not keep_template:
                 templates = templatesT
+    if not license_file.exists():
+        directory = "./"
     templates = TemplateManager(templates)
+    budget = None
+    if args['io_limit'] or args['files_limit'] or args['io_control']:
+        budget = IOBudget(args['io_limit'], args['files_limit'],
+                          args['io_control'])
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, budget.request_reload)
+    results = ResultStream(args['results'], shard=args['shard'],
+                           budget=budget)
+
+    path_filter = PathFilter(directory)
+    path_filter.add_pattern(".git/")
+    if os.path.isfile(directory + ".gitignore"):
+        path_filter.add_patterns_file(directory + ".gitignore")
+    for patterns_location in args['exclude_from']:
+        path_filter.add_patterns_file(patterns_location)
+    for pattern in args['filters'] or []:
+        path_filter.add_pattern(pattern)
+    path_filter.compile()
+
+    journal = None
+    if args['journal']:
+        journal = Journal(args['journal'], args['resume'])
+        # Let a terminated run flush the journal on its way out
+        signal.signal(signal.SIGTERM, lambda signum, frame: exit(1))
+
+    patch = None
+    if args['emit_patch']:
+        patch = PatchWriter(args['emit_patch'], directory)
 
-    file_list = list(set(args['files']))  # The list of non-duplicate files
-    for src_file in file_list:
-        heading = Header(username, email, src_file)
-        template = templates.search_templates(heading.get_extension())
-        if not template:
-            templates.update_registry_file()
-            template = templates.search_templates(heading.get_extension())
-            if not template:
-                print("Error: Template for", heading.get_extension(),
-                      "not found")
-                exit(1)
-        # print ("DEBUG > ext: {0} template:
-        # {1}".format(heading.get_extension(), template))
-        head = template.generate_header(heading)
-
-        # filename = src_file
-
-        # Make the backup hidden
-        tmp_name = "."
-        tmp_name += random_name_generator()
-        tmp_name += ".bak"
-
-        template_include = template.get_include()
-
-        header_written = False
-        with open(src_file, 'r') as s:
-            with open(tmp_name, 'w') as d:
-                if not template.is_include_top():
-                    d.write(head)
-                    header_written = True
-                    for line in s:
-                        d.write(line)
-                else:
-                    for line in s:
-                        if (template_include in line) or (line is
-                                                          string.whitespace):
-                            pass
-                        elif not header_written:
-                            d.write(head)
-                            header_written = True
-                        d.write(line)
-
-        # Put the file back where it goes
-        os.rename(tmp_name, src_file)
+    try:
+        if args['archive']:
+            process_archive(args['archive'][0], args['archive'][1], username,
+                            email, templates, results, budget)
+        run_files(args['files'], username, email, templates, results,
+                  path_filter, directory, args['shard'], journal, budget,
+                  patch)
+    finally:
+        if patch:
+            patch.close()
+        if journal:
+            journal.close()
+        results.close()
+    if results.get_error_count():
+        exit(1)
     # Disabled until threading figured out
     # max_threads = multiprocessing.cpu_count()
     # file_list = filechunks(args['files'], max_threads)
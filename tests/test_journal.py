@@ -0,0 +1,47 @@
+#
+# test_journal.py
+#
+# Tests for resuming an interrupted run from its journal.
+#
+
+import os
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import license  # noqa: E402
+
+
+def test_resume_skips_written_files_missing_from_journal(tmp_path):
+    templates_location = str(tmp_path / "templates")
+    shutil.copytree(os.path.join(ROOT, "templates"), templates_location)
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "a.py").write_text("x = 1\n")
+    (src / "b.c").write_text("#include <a>\nint x;\n")
+    (src / "c.py").write_text("y = 2\n")
+    templates = license.TemplateManager(templates_location)
+
+    # The interrupted run wrote these files, but died before the journal
+    # was flushed
+    for name in ("a.py", "b.c"):
+        record = license.process_file(str(src / name), "Bob",
+                                      "bob@example.com", templates)
+        assert record["action"] == "written"
+
+    path_filter = license.PathFilter(str(tmp_path))
+    path_filter.compile()
+    journal_location = str(tmp_path / "journal.jsonl")
+    open(journal_location, "w").close()
+    journal = license.Journal(journal_location, resume=True)
+    results = license.ResultStream(progress=False)
+    license.run_files([str(src)], "Bob", "bob@example.com", templates,
+                      results, path_filter, str(tmp_path), journal=journal)
+    journal.close()
+    results.close()
+
+    assert results.summary()["actions"] == {"existing": 2, "written": 1}
+    for name in ("a.py", "b.c", "c.py"):
+        assert (src / name).read_text().count("bob@example.com") == 1
@@ -0,0 +1,66 @@
+#
+# test_memory.py
+#
+# Memory ceiling regression tests. The pipeline is run over generated trees of
+# growing size and its peak memory must stay flat. Anything that buffers a
+# value per file (a list of paths, a set of seen files, kept result records)
+# makes the peak grow with the tree.
+#
+
+import os
+import shutil
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import license  # noqa: E402
+
+# Allowed growth of the peak from 1k to 10k files, a leak of 4 bytes per file
+# already exceeds it
+PEAK_GROWTH = 32 * 1024
+FILES_PER_FOLDER = 100
+
+
+def make_tree(root, count):
+    """Creates count python files, spread over folders of 100 files"""
+    for i in range(count):
+        folder = os.path.join(root, "d{0}".format(i // FILES_PER_FOLDER))
+        if i % FILES_PER_FOLDER == 0:
+            os.makedirs(folder)
+        with open(os.path.join(folder, "f{0}.py".format(i)), "w") as f:
+            f.write("x = 1\n")
+
+
+def measure_peak(location, count):
+    """Returns the peak traced memory of a run over a tree of count files"""
+    os.makedirs(location)
+    templates_location = os.path.join(location, "templates")
+    shutil.copytree(os.path.join(ROOT, "templates"), templates_location)
+    tree = os.path.join(location, "src")
+    make_tree(tree, count)
+
+    templates = license.TemplateManager(templates_location)
+    path_filter = license.PathFilter(tree)
+    path_filter.compile()
+    results = license.ResultStream(os.path.join(location, "results.jsonl"),
+                                   progress=False)
+
+    tracemalloc.start()
+    try:
+        license.run_files([tree], "Bob", "bob@example.com", templates,
+                          results, path_filter, tree)
+        (_, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        results.close()
+
+    assert results.summary()["actions"] == {"written": count}
+    return peak
+
+
+def test_peak_memory_is_flat(tmp_path):
+    small = measure_peak(str(tmp_path / "small"), 1000)
+    large = measure_peak(str(tmp_path / "large"), 10000)
+    assert large - small < PEAK_GROWTH
@@ -0,0 +1,40 @@
+#
+# test_registry.py
+#
+# Tests for keeping the template registry in sync with the template folder.
+#
+
+import os
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import license  # noqa: E402
+
+
+def test_unknown_extension_rebuilds_only_after_template_change(tmp_path):
+    templates_location = str(tmp_path / "templates")
+    shutil.copytree(os.path.join(ROOT, "templates"), templates_location)
+    registry_location = os.path.join(templates_location, ".file_types.db")
+    license.TemplateManager(templates_location)
+    stamp = os.stat(registry_location)
+
+    # A manager loaded after the registry was written must not rebuild it
+    templates = license.TemplateManager(templates_location)
+    assert templates.search_templates("md") is None
+    assert os.stat(registry_location) == stamp
+
+    with open(os.path.join(templates_location, "py.template")) as f:
+        template = f.read().replace("TYPE:py", "TYPE:md")
+    new_location = os.path.join(templates_location, "md.template")
+    with open(new_location, "w") as f:
+        f.write(template)
+    os.utime(new_location, ns=(stamp.st_mtime_ns + 1, stamp.st_mtime_ns + 1))
+    os.utime(templates_location,
+             ns=(stamp.st_mtime_ns + 1, stamp.st_mtime_ns + 1))
+
+    templates = license.TemplateManager(templates_location)
+    assert templates.search_templates("md") is not None
+    assert os.stat(registry_location) != stamp
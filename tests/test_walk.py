@@ -0,0 +1,37 @@
+#
+# test_walk.py
+#
+# Tests for the files and folders a run visits.
+#
+
+import os
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import license  # noqa: E402
+
+
+def test_overlapping_arguments_are_written_once(tmp_path):
+    templates_location = str(tmp_path / "templates")
+    shutil.copytree(os.path.join(ROOT, "templates"), templates_location)
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    (src / "a.py").write_text("x = 1\n")
+    (src / "sub" / "b.py").write_text("y = 2\n")
+
+    templates = license.TemplateManager(templates_location)
+    path_filter = license.PathFilter(str(tmp_path))
+    path_filter.compile()
+    results = license.ResultStream(progress=False)
+    license.run_files([str(src), str(src / "a.py"), str(src / "sub"),
+                       str(src) + "/"],
+                      "Bob", "bob@example.com", templates, results,
+                      path_filter, str(tmp_path))
+    results.close()
+
+    assert results.summary()["actions"] == {"written": 2}
+    assert (src / "a.py").read_text().count("Author: Bob") == 1
+    assert (src / "sub" / "b.py").read_text().count("Author: Bob") == 1